@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+# channel fan-out throughput without sockets: ./bench_ircd.py
+
+import time
+
+import ircd
+
+class NullConnection:
+	addr = None
+
+	def __init__(self):
+		self.queued = []
+
+	def write(self, data):
+		self.queued.append(data)
+
+def make_channel(size):
+	channel = ircd.Channel('#bench')
+	for i in range(size):
+		user = ircd.User(NullConnection())
+		user.nick = 'user%d' % i
+		user.source = '%s!user@bench' % user.nick
+		channel.users.add(user)
+	return channel
+
+def drain(channel):
+	for user in channel.users:
+		user.conn.queued.clear()
+
+def per_recipient(channel, sender, text):
+	# what Channel.privmsg used to do: format and encode once per member
+	for u in channel.users:
+		if u is not sender:
+			u.send('PRIVMSG', text, target=channel.name, source=sender.nick)
+
+def broadcast(channel, sender, text):
+	channel.privmsg(sender, text)
+
+def run(func, channel, messages):
+	sender = next(iter(channel.users))
+	start = time.perf_counter()
+	for i in range(messages):
+		func(channel, sender, 'fleet is forming up in jita, x up %d' % i)
+	elapsed = time.perf_counter() - start
+	drain(channel)
+	return messages / elapsed
+
+def main():
+	print('%8s %14s %14s %18s' % ('users', 'per-recipient', 'broadcast', 'deliveries/s'))
+	for size in [10, 100, 1000]:
+		channel = make_channel(size)
+		messages = max(100, 200000 // size)
+		old = run(per_recipient, channel, messages)
+		new = run(broadcast, channel, messages)
+		print('%8d %12.0f/s %12.0f/s %18.0f' % (size, old, new, new * (size - 1)))
+
+if __name__ == '__main__':
+	main()
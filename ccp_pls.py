@@ -1,8 +1,16 @@
 from xml.etree import ElementTree
 
+import collections
 from datetime import datetime, timedelta
+import io
+import sqlite3
+import threading
+import time
+
 import requests
 
+import config
+
 
 base_url = 'https://api.eveonline.com'
 
@@ -30,26 +38,155 @@ def key_info(key_id, vcode):
 	return info
 
 def alliance_contact_list(key_id, key_vcode, char_id):
-	xml = query('/char/ContactList.xml.aspx', key_id, key_vcode, char_id)
-	if not xml:
-		return
-	cached_until = datetime.strptime(xml.find('cachedUntil').text, '%Y-%m-%d %H:%M:%S')
-	current_time = datetime.strptime(xml.find('currentTime').text, '%Y-%m-%d %H:%M:%S')
-	if timedelta(minutes=15) != (cached_until - current_time):
+	''' {contact id: (name, standing, type id)}, streamed out of the raw response '''
+	body = query('/char/ContactList.xml.aspx', key_id, key_vcode, char_id, raw=True)
+	contacts = {}
+	times = {}
+	rowset = None
+	have_result = False
+	for event, elem in ElementTree.iterparse(io.BytesIO(body), events=('start', 'end')):
+		if event == 'start':
+			if elem.tag == 'rowset':
+				rowset = elem.get('name')
+			continue
+		if elem.tag == 'row' and rowset == 'allianceContactList':
+			contacts[int(elem.get('contactID'))] = \
+					(elem.get('contactName'), float(elem.get('standing')), int(elem.get('contactTypeID')))
+		elif elem.tag in ('currentTime', 'cachedUntil'):
+			times[elem.tag] = datetime.strptime(elem.text, '%Y-%m-%d %H:%M:%S')
+		elif elem.tag == 'result':
+			have_result = True
+		elif elem.tag == 'rowset':
+			rowset = None
+		elem.clear() # rows are dropped as soon as they're read
+	if not have_result or len(times) != 2:
+		return None
+	if timedelta(minutes=15) != (times['cachedUntil'] - times['currentTime']):
 		return None
-	result = xml.find('result')
-	contacts = []
-	for row in result.findall('./rowset[@name="allianceContactList"]/'):
-		contacts.append({
-			'id' : int(row.get('contactID')),
-			'contact_name': row.get('contactName'),
-			'standing': float(row.get('standing')),
-			'type_id': int(row.get('contactTypeID')),
-		})
 	return contacts
 
+class RateLimiter:
+	''' token bucket shared by every caller of query() '''
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			if self.tokens < 1:
+				# hold the lock while sleeping so waiters are served in order
+				time.sleep((1 - self.tokens) / self.rate)
+				self.tokens = 1
+				self.last = time.monotonic()
+			self.tokens -= 1
+
+class ResponseCache:
+	''' parsed responses kept until their cachedUntil, LRU-evicted, optionally spilled to an sqlite file '''
+	def __init__(self, max_entries, path=None):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict() # key -> (expires, body, xml or None until someone needs the tree)
+		self.disk = None
+		if path:
+			# sqlite does its own file locking, so the web app and update_entities can share one file
+			self.disk = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+			self.disk.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, body BLOB)')
+		self.lock = threading.Lock()
+		self.hits = self.disk_hits = self.misses = 0
+
+	def get(self, key, raw=False):
+		''' the parsed response, or with raw the body it was parsed from '''
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				if entry[0] > now:
+					self.entries.move_to_end(key)
+					self.hits += 1
+					expires, body, xml = entry
+					if raw:
+						return body
+					if xml is None:
+						xml = ElementTree.fromstring(body)
+						self.entries[key] = (expires, body, xml)
+					return xml
+				del self.entries[key]
+			if self.disk is not None:
+				disk_key = self._disk_key(key)
+				stored = self.disk.execute('SELECT expires, body FROM responses WHERE key = ?', (disk_key,)).fetchone()
+				if stored is not None:
+					expires, body = stored
+					if expires > now:
+						xml = None if raw else ElementTree.fromstring(body)
+						self._remember(key, expires, body, xml)
+						self.disk_hits += 1
+						return body if raw else xml
+					self.disk.execute('DELETE FROM responses WHERE key = ?', (disk_key,))
+			self.misses += 1
+
+	def put(self, key, body, xml=None):
+		''' remember a response; without its tree, the timestamps are streamed out of body '''
+		if xml is not None:
+			times = {tag: xml.findtext(tag) for tag in ('currentTime', 'cachedUntil')}
+		else:
+			times = {}
+			for _, elem in ElementTree.iterparse(io.BytesIO(body)):
+				if elem.tag in ('currentTime', 'cachedUntil'):
+					times[elem.tag] = elem.text
+					if len(times) == 2:
+						break
+				elem.clear()
+		if not times.get('currentTime') or not times.get('cachedUntil'): # not an API response
+			return
+		cached_until = datetime.strptime(times['cachedUntil'], '%Y-%m-%d %H:%M:%S')
+		current_time = datetime.strptime(times['currentTime'], '%Y-%m-%d %H:%M:%S')
+		# both timestamps are the API server's clock, so only trust the difference
+		expires = time.time() + (cached_until - current_time).total_seconds()
+		with self.lock:
+			self._remember(key, expires, body, xml)
+			if self.disk is not None:
+				self.disk.execute('INSERT OR REPLACE INTO responses (key, expires, body) VALUES (?, ?, ?)',
+						(self._disk_key(key), expires, body))
+
+	def stats(self):
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'hits': self.hits,
+				'disk_hits': self.disk_hits,
+				'misses': self.misses,
+			}
+
+	def _remember(self, key, expires, body, xml):
+		self.entries[key] = (expires, body, xml)
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+
+	@staticmethod
+	def _disk_key(key):
+		return '\0'.join(key)
+
+rate_limiter = RateLimiter(config.api_rate_limit, config.api_rate_burst)
+response_cache = ResponseCache(config.api_cache_size, config.api_cache_path)
 rs = requests.Session()
-def query(endpoint, key_id, vcode, char_id=None):
+def query(endpoint, key_id, vcode, char_id=None, raw=False):
+	# the vCode is part of the key so a wrong one can never be answered from the cache
+	key = (endpoint, str(key_id), str(vcode), str(char_id))
+	cached = response_cache.get(key, raw)
+	if cached is not None:
+		return cached
+	rate_limiter.acquire()
 	response = rs.get(base_url + endpoint, params={'keyID': key_id, 'vCode': vcode, 'characterID': char_id})
+	if raw:
+		# the caller streams it; don't build a tree nobody will look at
+		response_cache.put(key, response.content)
+		return response.content
 	xml = ElementTree.fromstring(response.content)
+	response_cache.put(key, response.content, xml)
 	return xml
@@ -1,22 +1,92 @@
 import binascii
+from collections import namedtuple
 import hashlib
+import hmac
 import os
+import time
+
+try:
+	import eventlet.patcher
+	import eventlet.tpool
+except ImportError:
+	eventlet = None
 
 import sqlalchemy
 from sqlalchemy import Column, Enum, ForeignKey, Integer, String, UniqueConstraint, Float
-from sqlalchemy.orm import backref, joinedload, relationship
+from sqlalchemy.orm import backref, relationship
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
+import sqlalchemy.pool
 
 import config
 
-import postgresql.clientparameters
-postgresql.clientparameters.default_host = None
-engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL(
-	drivername='postgresql+pypostgresql',
-	username=config.db_user,
-	database=config.database,
-	query={'unix': '/var/run/postgresql/.s.PGSQL.5432', 'port': None}
-), echo=config.debug)
+class MeteredQueuePool(sqlalchemy.pool.QueuePool):
+	''' a QueuePool that counts checkouts and how long callers waited for a connection '''
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.checkouts = self.timeouts = 0
+		self.wait_total = self.wait_max = 0.0
+
+	def _do_get(self):
+		start = time.perf_counter()
+		try:
+			return super()._do_get()
+		except sqlalchemy.exc.TimeoutError:
+			self.timeouts += 1
+			raise
+		finally:
+			waited = time.perf_counter() - start
+			self.checkouts += 1
+			self.wait_total += waited
+			self.wait_max = max(self.wait_max, waited)
+
+	def stats(self):
+		return {
+			'size': self.size(),
+			'checked_out': self.checkedout(),
+			'overflow': self.overflow(),
+			'checkouts': self.checkouts,
+			'timeouts': self.timeouts,
+			'wait_avg_ms': self.wait_total / self.checkouts * 1000 if self.checkouts else 0,
+			'wait_max_ms': self.wait_max * 1000,
+		}
+
+def _engine_url():
+	if config.db_driver == 'psycopg2':
+		return sqlalchemy.engine.url.URL(
+			drivername='postgresql+psycopg2',
+			username=config.db_user,
+			database=config.database,
+			query={'host': '/var/run/postgresql'},
+		)
+	import postgresql.clientparameters
+	postgresql.clientparameters.default_host = None
+	return sqlalchemy.engine.url.URL(
+		drivername='postgresql+pypostgresql',
+		username=config.db_user,
+		database=config.database,
+		query={'unix': '/var/run/postgresql/.s.PGSQL.5432', 'port': None}
+	)
+
+def error_code(e):
+	''' the SQLSTATE of a DBAPIError, whichever driver raised it '''
+	return getattr(e.orig, 'pgcode', None) or getattr(e.orig, 'code', None) # psycopg2, pypostgresql
+
+_pool_options = {}
+if config.db_pool_pre_ping:
+	_pool_options['pool_pre_ping'] = True # SQLAlchemy 1.2+
+engine = sqlalchemy.create_engine(_engine_url(), echo=config.debug, poolclass=MeteredQueuePool,
+		pool_size=config.db_pool_size, max_overflow=config.db_max_overflow,
+		pool_timeout=config.db_pool_timeout, pool_recycle=config.db_pool_recycle, **_pool_options)
+if eventlet is not None:
+	eventlet.tpool.set_num_threads(config.hash_threads)
+
+def offload(func, *args):
+	''' run func on a real OS thread when called from a greenlet so the hub keeps running '''
+	if eventlet is not None and eventlet.patcher.is_monkey_patched('thread'):
+		return eventlet.tpool.execute(func, *args)
+	return func(*args)
+
 session = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(
 		autocommit=False, autoflush=False, bind=engine))
 Base = sqlalchemy.ext.declarative.declarative_base()
@@ -34,6 +104,54 @@ class Entity(Base):
 	def __repr__(self):
 		return '<Entity(id=%r, type=%r, name=%r, parent_id=%r)>' % (self.id, self.type, self.name, self.parent_id)
 
+EntityRow = namedtuple('EntityRow', 'id type name')
+entity_types = Entity.type.property.columns[0].type.enums
+
+def ancestry(character_ids):
+	''' recursive CTE of (character_id, id, type, name, parent_id) for the characters and everything above them '''
+	# character_ids may be a list or a select of ids
+	entities = Entity.__table__
+	chain = sqlalchemy.select([
+		entities.c.id.label('character_id'), entities.c.id, entities.c.type, entities.c.name, entities.c.parent_id,
+	]).where(entities.c.id.in_(character_ids)).cte('chain', recursive=True)
+	parent = entities.alias('parent')
+	return chain.union_all(sqlalchemy.select([
+		chain.c.character_id, parent.c.id, parent.c.type, parent.c.name, parent.c.parent_id,
+	]).where(parent.c.id == chain.c.parent_id))
+
+def resolve_entities(character_ids):
+	''' {character_id: {type: EntityRow or None}} for any number of characters in one round trip '''
+	resolved = {}
+	for row in session.execute(_entities_statement(character_ids)):
+		entities = resolved.get(row.character_id)
+		if entities is None:
+			entities = resolved[row.character_id] = dict.fromkeys(entity_types, None)
+		entities[row.type] = EntityRow(row.id, row.type, row.name)
+	return resolved
+
+def _entities_statement(character_ids):
+	chain = ancestry(character_ids)
+	return sqlalchemy.select([chain.c.character_id, chain.c.id, chain.c.type, chain.c.name])
+
+# byte-order comparison, so a prefix is a plain range over entities_name_key_idx
+entity_name_key = sqlalchemy.literal_column('lower(entities.name) COLLATE "C"')
+
+def search_entities(prefix, after=None, limit=50):
+	''' (key, EntityRow) for entities whose name starts with prefix, after the (key, id) of a previous page '''
+	query = _search_query(prefix, after, limit)
+	return [(row.key, EntityRow(row.id, row.type, row.name)) for row in query]
+
+def _search_query(prefix, after, limit):
+	query = session.query(entity_name_key.label('key'), Entity.id, Entity.type, Entity.name)
+	prefix = prefix.lower()
+	if prefix:
+		# a range rather than LIKE so the index is still used by a generic plan
+		upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+		query = query.filter(entity_name_key >= prefix, entity_name_key < upper)
+	if after is not None:
+		query = query.filter(sqlalchemy.tuple_(entity_name_key, Entity.id) > sqlalchemy.tuple_(*after))
+	return query.order_by(entity_name_key, Entity.id).limit(limit)
+
 class User(Base):
 	__tablename__ = 'users'
 	id = Column(Integer, primary_key=True)
@@ -52,37 +170,16 @@ class User(Base):
 	def hash_pw(password, salt=None):
 		if salt is None:
 			salt = os.urandom(16)
-		hashed = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, 100000)
+		# pbkdf2_hmac releases the GIL, so concurrent logins really do run in parallel
+		hashed = offload(hashlib.pbkdf2_hmac, 'sha512', password.encode('utf-8'), salt, 100000)
 		hashed_hex = binascii.hexlify(hashed).decode()
 		salt_hex = binascii.hexlify(salt).decode()
 		return hashed_hex, salt_hex
 
 	@staticmethod
-	def login(username, password):
-		user = session.query(User).filter(User.username==username).first()
-		if not user:
-			return False
-		hashed, _ = User.hash_pw(password, binascii.unhexlify(user.salt.encode()))
-		if hashed == user.password:
-			return user
-
-	def entities(self):
-		# default all entity types to None
-		entities = dict.fromkeys(Entity.type.property.columns[0].type.enums, None)
-		entity = session.query(Entity).filter(Entity.id==self.character_id) \
-				.options(joinedload('parent').joinedload('parent').joinedload('parent')).one()
-		while entity:
-			entities[entity.type] = entity
-			entity = entity.parent
-		return entities
-
-	def groups(self, entities):
-		entity_ids = []
-		for entity in entities.values():
-			if entity:
-				entity_ids.append(entity.id)
-		groups = session.query(Group).join(Entity.groups).filter(Entity.id.in_(entity_ids))
-		return list(groups)
+	def verify_pw(password, salt_hex, hashed_hex):
+		hashed, _ = User.hash_pw(password, binascii.unhexlify(salt_hex.encode()))
+		return hmac.compare_digest(hashed, hashed_hex)
 
 	def __repr__(self):
 		return '<User(id=%r, username=%r, character_id=%r)>' % (self.id, self.username, self.character_id)
@@ -115,6 +212,203 @@ class Group(Base):
 				return True
 		return False
 
+# every group a character is in, directly or through its corporation/alliance
+effective_group = sqlalchemy.Table('effective_groups', Base.metadata,
+	Column('character_id', Integer, ForeignKey('entities.id'), primary_key=True),
+	Column('group_id', Integer, ForeignKey('groups.id'), primary_key=True),
+)
+
+def refresh_effective_groups(character_ids=None):
+	''' rebuild effective_groups for some characters (default everyone); the caller commits, then invalidates user_cache '''
+	entities = Entity.__table__
+	delete = effective_group.delete()
+	if character_ids is None:
+		characters = sqlalchemy.select([entities.c.id]).where(entities.c.type == 'character').correlate(None)
+		chain = ancestry(characters)
+	else:
+		chain = ancestry(character_ids)
+		delete = delete.where(effective_group.c.character_id.in_(character_ids))
+	gm = group_membership
+	memberships = sqlalchemy.select([chain.c.character_id, gm.c.group_id]) \
+			.select_from(chain.join(gm, gm.c.entity_id == chain.c.id)).distinct()
+	# concurrent rebuilds can't see each other's uncommitted inserts, so they'd collide on the primary key;
+	# the lock (held until the caller commits) makes them take turns while readers carry on
+	session.execute('LOCK TABLE effective_groups IN EXCLUSIVE MODE')
+	session.execute(delete)
+	session.execute(effective_group.insert().from_select(['character_id', 'group_id'], memberships))
+
+ResolvedUser = namedtuple('ResolvedUser', 'id username flags entities group_names')
+
+class CredentialCache:
+	''' recently verified passwords, so reconnect storms don't redo PBKDF2 for every client '''
+	# only the password check is cached; flags, entities and groups always come from the current row
+	def __init__(self, ttl):
+		self.ttl = ttl
+		# keyed by a keyed hash of the credentials, never the plaintext or the stored hash
+		self.secret = os.urandom(32)
+		self.entries = {} # digest -> (expires, username, stored password hash)
+		self.next_sweep = 64
+		self.hits = self.misses = self.invalidations = 0
+
+	def get(self, username, password, stored_hash):
+		''' whether this password was recently verified against stored_hash '''
+		entry = self.entries.get(self._digest(username, password))
+		# a password changed by another process changes the stored hash, so the entry stops matching
+		if entry is not None and entry[0] > time.monotonic() and entry[2] == stored_hash:
+			self.hits += 1
+			return True
+		self.misses += 1
+		return False
+
+	def put(self, username, password, stored_hash):
+		now = time.monotonic()
+		if len(self.entries) >= self.next_sweep:
+			for digest, entry in list(self.entries.items()):
+				if entry[0] <= now:
+					self.entries.pop(digest, None) # another thread may have swept it already
+			self.next_sweep = max(64, len(self.entries) * 2)
+		self.entries[self._digest(username, password)] = (now + self.ttl, username, stored_hash)
+
+	def invalidate(self, usernames=None):
+		self.invalidations += 1
+		if usernames is None:
+			self.entries.clear()
+		else:
+			for digest, entry in list(self.entries.items()):
+				if entry[1] in usernames:
+					self.entries.pop(digest, None)
+
+	def stats(self):
+		return {
+			'entries': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'invalidations': self.invalidations,
+		}
+
+	def _digest(self, username, password):
+		return hashlib.blake2b((username + '\0' + password).encode('utf-8'), key=self.secret).digest()
+
+credential_cache = CredentialCache(config.credential_cache_ttl)
+
+def resolve_users(user_ids=None, usernames=None):
+	''' ResolvedUsers for the given ids and/or usernames in three queries, however many there are '''
+	users = User.__table__
+	conditions = []
+	if user_ids:
+		conditions.append(users.c.id.in_(user_ids))
+	if usernames:
+		conditions.append(users.c.username.in_(usernames))
+	if not conditions:
+		return []
+	rows = session.execute(sqlalchemy.select([users.c.id, users.c.username, users.c.flags, users.c.character_id])
+			.where(sqlalchemy.or_(*conditions))).fetchall()
+	if not rows:
+		return []
+	character_ids = [row.character_id for row in rows]
+	entities = resolve_entities(character_ids)
+	group_names = {character_id: [] for character_id in character_ids}
+	groups = sqlalchemy.select([effective_group.c.character_id, Group.__table__.c.name]) \
+			.select_from(effective_group.join(Group.__table__, Group.__table__.c.id == effective_group.c.group_id)) \
+			.where(effective_group.c.character_id.in_(character_ids))
+	for character_id, name in session.execute(groups):
+		group_names[character_id].append(name)
+	return [ResolvedUser(row.id, row.username, row.flags, entities[row.character_id], group_names[row.character_id])
+			for row in rows]
+
+class UserCache:
+	''' ResolvedUsers for logged-in web sessions, by user id '''
+	# invalidated here on every change this process makes, expired after ttl for the rest
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self.entries = {} # user_id -> (expires, ResolvedUser)
+		self.hits = self.misses = self.invalidations = 0
+
+	def get(self, user_id):
+		''' the ResolvedUser, or None if there's no such user '''
+		entry = self.entries.get(user_id)
+		if entry is not None and entry[0] > time.monotonic():
+			self.hits += 1
+			return entry[1]
+		self.misses += 1
+		resolved = resolve_users(user_ids=[user_id])
+		if not resolved:
+			self.entries.pop(user_id, None)
+			return None
+		if self.ttl:
+			self.entries[user_id] = (time.monotonic() + self.ttl, resolved[0])
+		return resolved[0]
+
+	def invalidate(self, user_ids=None, character_ids=None):
+		''' drop the given users, the users of the given characters, or (with neither) everyone '''
+		self.invalidations += 1
+		if user_ids is None and character_ids is None:
+			self.entries.clear()
+			return
+		for user_id in user_ids or []:
+			self.entries.pop(user_id, None)
+		if character_ids is not None:
+			character_ids = set(character_ids)
+			for user_id, entry in list(self.entries.items()):
+				if entry[1].entities['character'].id in character_ids:
+					del self.entries[user_id]
+
+	def stats(self):
+		return {
+			'entries': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'invalidations': self.invalidations,
+		}
+
+user_cache = UserCache(config.user_cache_ttl)
+
+AuthRow = namedtuple('AuthRow', 'id username password salt flags entities group_names')
+
+def _auth_query():
+	users = User.__table__
+	character = sqlalchemy.select([users.c.character_id]) \
+			.where(users.c.username == sqlalchemy.bindparam('username')).correlate(None)
+	chain = ancestry(character)
+	group_names = sqlalchemy.select([sqlalchemy.func.array_agg(Group.__table__.c.name)]) \
+			.select_from(effective_group.join(Group.__table__, Group.__table__.c.id == effective_group.c.group_id)) \
+			.where(effective_group.c.character_id == users.c.character_id).as_scalar()
+	# one row per level of the character's chain
+	return sqlalchemy.select([
+		users.c.id, users.c.username, users.c.password, users.c.salt, users.c.flags,
+		chain.c.id.label('entity_id'), chain.c.type.label('entity_type'), chain.c.name.label('entity_name'),
+		group_names.label('group_names'),
+	]).select_from(users.join(chain, chain.c.character_id == users.c.character_id)) \
+			.where(users.c.username == sqlalchemy.bindparam('username'))
+auth_query = _auth_query()
+# auth_query is built once, so its compiled SQL can be reused on every login instead of recompiling the CTE
+auth_compiled_cache = {}
+
+def resolve_auth(username):
+	''' the user row, character chain and group names for username in one statement, or None '''
+	conn = session.connection().execution_options(compiled_cache=auth_compiled_cache)
+	rows = conn.execute(auth_query, {'username': username}).fetchall()
+	if not rows:
+		return None
+	entities = dict.fromkeys(entity_types, None)
+	for row in rows:
+		entities[row.entity_type] = EntityRow(row.entity_id, row.entity_type, row.entity_name)
+	row = rows[0]
+	return AuthRow(row.id, row.username, row.password, row.salt, row.flags,
+			entities, list(row.group_names or []))
+
+def authenticate(username, password):
+	''' None for an unknown username, False for a wrong password, otherwise a ResolvedUser '''
+	row = resolve_auth(username)
+	if row is None:
+		return None
+	if not credential_cache.get(username, password, row.password):
+		if not User.verify_pw(password, row.salt, row.password):
+			return False
+		credential_cache.put(username, password, row.password)
+	# built from the row just read, so flag and group changes apply on the next login in every process
+	return ResolvedUser(row.id, row.username, row.flags, row.entities, row.group_names)
+
 class Contact(Base):
 	__tablename__ = 'contacts'
 	id = Column(Integer, primary_key=True)
@@ -141,14 +435,99 @@ class Contact(Base):
 
 Group.grim_sleepers = Group(id=1, name='grim sleepers')
 
-def init_db():
+# secondary indexes live here rather than on the models so migrate can add them to existing databases;
+# every statement is idempotent
+extra_ddl = [
+	'CREATE INDEX IF NOT EXISTS entities_name_key_idx ON entities ((lower(name) COLLATE "C"), id)',
+	# resolve_entities and refresh_effective_groups walk parent_id; corp/alliance deletes check it too
+	'CREATE INDEX IF NOT EXISTS entities_parent_id_idx ON entities (parent_id)',
+	# the unique (group_id, entity_id) constraint already covers lookups by group
+	'CREATE INDEX IF NOT EXISTS group_memberships_entity_id_idx ON group_memberships (entity_id)',
+	'CREATE INDEX IF NOT EXISTS effective_groups_group_id_idx ON effective_groups (group_id)',
+]
+
+def create_schema():
 	Base.metadata.create_all(bind=engine)
+	with engine.begin() as conn:
+		for statement in extra_ddl:
+			conn.execute(statement)
+
+def init_db():
+	create_schema()
 	session.add_all([
 		Group.grim_sleepers,
 	])
 	session.commit()
 def drop_db():
 	Base.metadata.drop_all(bind=engine)
+def migrate_db():
+	# create_all only creates tables that don't exist yet
+	create_schema()
+	refresh_effective_groups()
+	session.commit()
+
+def seed_db(characters, password=None):
+	''' synthetic entities and users (seed_0...) with negative ids in a 'seed' group; returns (first character id, group id) '''
+	# the caller commits or rolls back
+	hashed, salt = '0' * 128, '0' * 32
+	if password is not None:
+		hashed, salt = User.hash_pw(password)
+	alliances = max(1, characters // 500)
+	corporations = max(1, characters // 25)
+	rows = []
+	for i in range(alliances):
+		rows.append({'id': -1 - i, 'type': 'alliance', 'name': 'Seed Alliance %d' % i, 'parent_id': None})
+	for i in range(corporations):
+		rows.append({'id': -1 - alliances - i, 'type': 'corporation', 'name': 'Seed Corporation %d' % i,
+				'parent_id': -1 - i % alliances})
+	first_char = -1 - alliances - corporations
+	for i in range(characters):
+		rows.append({'id': first_char - i, 'type': 'character', 'name': 'Seed Character %d' % i,
+				'parent_id': -1 - alliances - i % corporations})
+	session.execute(Entity.__table__.insert(), rows)
+	session.execute(User.__table__.insert(), [{
+		'username': 'seed_%d' % i, 'password': hashed, 'salt': salt, 'email': 'seed_%d@example.com' % i,
+		'apikey_id': -1 - i, 'apikey_vcode': '0' * 64, 'character_id': first_char - i, 'flags': 0,
+	} for i in range(characters)])
+	group = Group(name='seed')
+	session.add(group)
+	session.flush()
+	session.execute(group_membership.insert(),
+			[{'group_id': group.id, 'entity_id': -1 - i} for i in range(alliances)])
+	refresh_effective_groups()
+	return first_char, group.id
+
+def unseed_db():
+	''' remove what seed_db added; the caller commits '''
+	session.execute(effective_group.delete().where(effective_group.c.character_id < 0))
+	session.execute(User.__table__.delete().where(User.character_id < 0))
+	seed_groups = sqlalchemy.select([Group.id]).where(Group.name == 'seed')
+	session.execute(group_membership.delete().where(group_membership.c.group_id.in_(seed_groups)))
+	session.execute(Group.__table__.delete().where(Group.name == 'seed'))
+	session.execute(Entity.__table__.delete().where(Entity.id < 0))
+
+def explain_db(characters):
+	''' EXPLAIN ANALYZE each hot query against a seeded database, then roll everything back '''
+	try:
+		character_id, group_id = seed_db(characters)
+		session.execute('ANALYZE')
+		members_query = session.query(Entity).join(group_membership) \
+				.filter(group_membership.c.group_id == group_id)
+		queries = [
+			('resolve_auth', auth_query.params(username='seed_0')),
+			('resolve_entities', _entities_statement([character_id])),
+			('search_entities', _search_query('seed c', None, 50).statement),
+			('search_entities next page', _search_query('seed c', ('seed character 5', character_id), 50).statement),
+			('group members', members_query.statement),
+		]
+		for name, statement in queries:
+			sql = statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+			print('--', name)
+			for row in session.execute(sqlalchemy.text('EXPLAIN ANALYZE ' + str(sql))):
+				print(row[0])
+			print()
+	finally:
+		session.rollback()
 
 if __name__ == '__main__':
 	import sys
@@ -157,3 +536,9 @@ if __name__ == '__main__':
 			init_db()
 		elif sys.argv[1] == 'drop':
 			drop_db()
+		elif sys.argv[1] == 'migrate':
+			migrate_db()
+		elif sys.argv[1] == 'explain':
+			explain_db(10000)
+	elif len(sys.argv) == 3 and sys.argv[1] == 'explain':
+		explain_db(int(sys.argv[2]))
@@ -1,22 +1,53 @@
 #!/usr/bin/env python3
 
-import eventlet
-eventlet.monkey_patch()
+import argparse
+import sys
 
+import config
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--core', choices=['eventlet', 'asyncio'], default=config.irc_core)
+	parser.add_argument('--port', type=int, default=config.irc_port)
+	parser.add_argument('--workers', type=int, default=config.irc_workers,
+			help='run this many worker processes sharing the port and channel state')
+	parser.add_argument('--bus', help=argparse.SUPPRESS) # set by the master for its workers
+	parser.add_argument('--database', help='use this database instead of config.database (for load tests)')
+	return parser.parse_args(argv)
+
+# the core has to be known before anything else is imported so eventlet can patch it
+args = parse_args(sys.argv[1:]) if __name__ == '__main__' else None
+if args and args.database:
+	config.database = args.database # before db is imported
+# (a master process running several workers only relays between them, on asyncio)
+if (args.core if args else config.irc_core) == 'eventlet' and not (args and args.workers > 1):
+	import eventlet
+	eventlet.monkey_patch()
+
+import asyncio
 import atexit
-from datetime import timedelta, datetime
+from collections import deque
 import errno
+import json
+import logging
+import os
 import socket
+import subprocess
+import time
 
-from sqlalchemy import orm
-
-import config
 import db
+import ircd_log
 
 users = {}
 channels = {}
+remote_users = {} # nick -> RemoteUser, for users on other worker processes
+auto_join = {} # group name -> channels its members join on registration; see load_auto_join
+bus = None # the Bus to the other workers, when running as one of several
 
-DEBUG = True
+server_log = logging.getLogger('ircd.server')
+conn_log = logging.getLogger('ircd.conn')
+proto_log = logging.getLogger('ircd.proto') # every line in and out, at DEBUG
+bus_log = logging.getLogger('ircd.bus')
 
 class RPL:
 	WELCOME = 1
@@ -36,7 +67,9 @@ class RPL:
 	MOTD_CONTENT = 372
 	MOTD_START = 375
 	MOTD_END = 376
+	NOSUCHNICK = 401
 	NOSUCHCHANNEL = 403
+	INPUTTOOLONG = 417
 	WASNOSUCHNICK = 406
 	UNKNOWNCOMMAND = 421
 	NONICKNAMEGIVEN = 431
@@ -46,126 +79,215 @@ class RPL:
 	UMODEUNKNOWNFLAG = 501
 	USERSDONTMATCH = 502
 
+class LineBuffer:
+	''' incremental framing of CR-LF (or bare LF) terminated lines '''
+	def __init__(self, max_length=512):
+		self.buf = bytearray()
+		self.max_length = max_length # including the line ending, per RFC 1459
+		self.discarding = False # skipping the rest of an overlong line
+
+	def feed(self, data):
+		''' yields each complete line without its ending, or None for an overlong line that was dropped '''
+		buf = self.buf
+		buf += data
+		start = 0
+		while True:
+			end = buf.find(b'\n', start)
+			if end == -1:
+				break
+			line_end = end
+			if line_end > start and buf[line_end - 1] == 13: # \r
+				line_end -= 1
+			if self.discarding:
+				self.discarding = False
+			elif line_end - start > self.max_length - 2:
+				yield None
+			else:
+				with memoryview(buf) as view:
+					line = bytes(view[start:line_end])
+				yield line
+			start = end + 1
+		# one compaction per recv, not one per line
+		del buf[:start]
+		tail = len(buf)
+		if tail and buf[-1] == 13: # a \r whose \n is still on its way isn't part of the line
+			tail -= 1
+		if tail > self.max_length - 2:
+			if not self.discarding:
+				self.discarding = True
+				yield None
+			buf.clear()
+
 class ClientMessage:
-	''' command, target, text '''
+	''' prefix, command, params; target and text are the first param and the rest '''
 	def __init__(self, line):
 		self.line = line
 
-		split = line.split(' ', 2) # this is technically wrong, but works for most things
-		self.command = split[0]
-		if len(split) > 1:
-			self.target = split[1]
-			if len(split) == 2 and self.target[0] == ':':
-				self.target = self.target[1:]
-		else:
-			self.target = None # this shouldn't happen
-		self.text = None
-		if len(split) > 2 and split[2]:
-			self.text = split[2]
-			if self.text[0] == ':':
-				self.text = self.text[1:]
+		self.prefix = None
+		if line.startswith(':'):
+			self.prefix, _, line = line[1:].partition(' ')
+		trailing = None
+		if line.startswith(':'):
+			line, trailing = '', line[1:]
+		elif ' :' in line:
+			line, trailing = line.split(' :', 1)
+		params = line.split()
+		self.command = params.pop(0).upper() if params else ''
+		if trailing is not None:
+			params.append(trailing)
+		self.params = params
+
+		self.target = self.text = None
+		if params:
+			self.target = params[0]
+		if len(params) > 1:
+			self.text = ' '.join(params[1:])
 
 	def __str__(self):
 		return '<ClientMessage>%s' % self.__dict__
 
+def format_line(command, *args, target, source=None):
+	''' the wire bytes for one message, ready to be queued to any number of users '''
+	if args and (' ' in args[-1] or args[-1].startswith(':')):
+		args = list(args)
+		args[-1] = ':' + args[-1]
+	line = '%s %s %s' % (command, target, ' '.join(args))
+	if source is not None:
+		line = ':%s %s' % (source, line)
+	proto_log.debug('-> %s', line)
+	return (line + '\r\n').encode('utf-8')
+
+class TimerWheel:
+	''' users due for an idle check, bucketed by second so a sweep only touches the due bucket '''
+	def __init__(self, slots=256):
+		self.slots = [set() for _ in range(slots)]
+		self.start = time.monotonic()
+		self.ticks = 0 # whole seconds since start; handle_message just copies this
+
+	def schedule(self, user, delay):
+		delay = max(1, min(delay, len(self.slots) - 1))
+		slot = self.slots[(self.ticks + delay) % len(self.slots)]
+		slot.add(user)
+		user.timer_slot = slot
+
+	def cancel(self, user):
+		if user.timer_slot is not None:
+			user.timer_slot.discard(user)
+			user.timer_slot = None
+
+	def advance(self):
+		''' yields every user whose check came due since the last call '''
+		now = int(time.monotonic() - self.start)
+		while self.ticks < now:
+			self.ticks += 1
+			slot = self.slots[self.ticks % len(self.slots)]
+			due = list(slot)
+			slot.clear()
+			for user in due:
+				user.timer_slot = None
+				yield user
+
+timers = TimerWheel()
+PING_AFTER = 3 * 60
+DISCONNECT_AFTER = 4 * 60
+
 class User:
-	def __init__(self, conn, addr):
+	def __init__(self, conn):
 		self.conn = conn
-		self.addr = addr
-		self.recv_greenlet = self.send_greenlet = None
-		self.send_queue = eventlet.queue.LightQueue()
-		self.last_buf = None
+		self.addr = conn.addr
+		self.lines = LineBuffer()
+		self.pending = deque()
+		self.waiting = self.disconnected = False
+		self.claimed = None # nick reserved with the other workers
 		self.nick = self.user = self.host = self.real_name = self.source = self.groups = None
 		self.password = None
 		self.channels = set()
-		self.last_recv_time = None
-
-	def handle_conn(self):
-		print('connected by', self.addr)
-		self.recv_greenlet = eventlet.getcurrent()
-		self.send_greenlet = eventlet.spawn(self.handle_send_queue)
-		self.last_recv_time = datetime.utcnow()
-		while True:
-			try:
-				data = self.conn.recv(4096)
-			except OSError as e:
-				if e.errno in [errno.EBADF, errno.ECONNRESET]:
-					self.disconnect()
-					break
-				raise
-			if not data:
-				self.disconnect()
-				break
-			if self.last_buf is not None:
-				data = self.last_buf + data
-				self.last_buf = None
-			lines = data.split(b'\r\n')
-			for i in range(len(lines) - 1):
-				line = str(lines[i], 'utf-8', 'replace')
-				if DEBUG:
-					print('<-', line)
-				message = ClientMessage(line)
-				self.handle_message(message)
-			last = lines[-1]
-			if last:
-				self.last_buf = last
-
-	def handle_send_queue(self):
-		while True:
-			line = self.send_queue.get()
-			try:
-				self.conn.sendall(line.encode('utf-8'))
-			except OSError as e:
-				if e.errno in [errno.EBADF, errno.ECONNRESET]:
-					self.disconnect()
-				else:
-					raise
+		self.last_recv = None
+		self.timer_slot = None
+
+	def connected(self):
+		conn_log.info('connected by %s', self.addr)
+		self.last_recv = timers.ticks
+		timers.schedule(self, PING_AFTER)
+
+	def feed(self, data):
+		for line in self.lines.feed(data):
+			if line is None:
+				self.send(RPL.INPUTTOOLONG, 'Input line was too long')
+				continue
+			line = str(line, 'utf-8', 'replace')
+			proto_log.debug('<- %s', line)
+			if line:
+				self.pending.append(ClientMessage(line))
+		self.handle_pending()
+
+	def handle_pending(self):
+		while self.pending and not self.waiting and not self.disconnected:
+			self.handle_message(self.pending.popleft())
+
+	def defer(self, func, callback):
+		''' run blocking func (database, hashing) off the event loop, then callback(result) '''
+		# messages that arrive in the meantime wait so they're still handled in order;
+		# callback runs even if we disconnected meanwhile, so it can clean up
+		self.waiting = True
+		def done(result):
+			self.waiting = False
+			callback(result)
+			self.handle_pending()
+		self.conn.defer(func, done)
 
 	def handle_message(self, msg):
-		self.last_recv_time = datetime.utcnow()
+		self.last_recv = timers.ticks
 		handler = User.handlers.get(msg.command)
 		if handler:
 			handler(self, msg)
 		else:
-			print('unhandled command', msg)
+			proto_log.info('unhandled command %s', msg)
 			self.send(RPL.UNKNOWNCOMMAND)
 
 	def send(self, command, *args, target=None, source=None):
 		if target is None:
 			target = self.nick
-		if args and (' ' in args[-1] or args[-1].startswith(':')):
-			args = list(args)
-			args[-1] = ':' + args[-1]
-		line = '%s %s %s' % (command, target, ' '.join(args))
-		if source is not None:
-			line = ':%s %s' % (source, line)
-		if DEBUG:
-			print('->', line)
-		line += '\r\n'
-		self.send_queue.put_nowait(line)
+		self.send_line(format_line(command, *args, target=target, source=source))
 
-	def disconnect(self):
-		print('disconnecting', self.addr)
-		current_greenlet = eventlet.getcurrent()
-		for greenlet in [self.recv_greenlet, self.send_greenlet]:
-			# we might be called by handle_conn/quit, handle_send_queue, or ping_all/disconnect_all
-			if greenlet is not current_greenlet:
-				greenlet.kill()
+	def send_line(self, data):
+		self.conn.write(data)
 
+	def disconnect(self):
+		if self.disconnected:
+			return
+		self.disconnected = True
+		conn_log.info('disconnecting %s', self.addr)
+		timers.cancel(self)
 		for channel in self.channels:
 			channel.quit(self)
+		if bus is not None:
+			if self.nick is not None:
+				bus.publish(op='quit', nick=self.nick,
+						data=format_line('QUIT', target='', source=self.source).decode('utf-8'))
+			else:
+				self.release_claim()
 		self.conn.close()
 		try:
 			del users[self.nick]
 		except KeyError:
 			pass
 
+	def release_claim(self):
+		''' give back a nick claimed but never registered, exactly once '''
+		if self.claimed is not None:
+			bus.publish(op='release', nick=self.claimed)
+			self.claimed = None
+
 	def check_timeout(self):
-		since = datetime.now() - self.last_recv_time
-		if since >= timedelta(minutes=4):
+		idle = timers.ticks - self.last_recv
+		if idle >= DISCONNECT_AFTER:
 			self.disconnect()
-		elif since >= timedelta(minutes=3):
-			self.send('PING', target=self.nick)
+		elif idle >= PING_AFTER:
+			self.send('PING', target=self.nick or '*')
+			timers.schedule(self, DISCONNECT_AFTER - idle)
+		else:
+			timers.schedule(self, PING_AFTER - idle)
 
 	# handlers
 
@@ -177,29 +299,46 @@ class User:
 			self.send(RPL.NONICKNAMEGIVEN)
 		elif not self.password:
 			self.send(RPL.ERRONEUSNICKNAME, 'No password specified.')
-		elif msg.target in users:
+		elif msg.target in users or msg.target in remote_users:
 			self.send(RPL.ERRONEUSNICKNAME, 'Already a User connected')
 			self.disconnect()
 		elif self.nick is None:
-			try:
-				user = db.User.login(msg.target, self.password)
-				if not user:
-					self.send(RPL.ERRONEUSNICKNAME, 'Invalid nick/password combination.')
-					self.disconnect()
-					return
-				entities = user.entities()
-				self.real_name = entities['character'].name
-				self.user = self.real_name.replace(' ', '_')
-				self.host = entities['corporation'].name.replace(' ', '.')
-				self.nick = msg.target
-				self.source = '%s!%s@%s' % (self.nick, self.user, self.host)
-				self.groups = user.groups(entities)
-			finally:
-				db.session.remove()
-			users[self.nick] = self
+			nick = msg.target
+			password = self.password
+			def authenticate():
+				try:
+					user = db.authenticate(nick, password)
+				finally:
+					db.session.remove()
+				if user and bus is not None:
+					if not Bus.claim(nick):
+						return user, False
+					self.claimed = nick
+				return user, True
+			self.defer(authenticate, lambda result: self._registered(nick, *result))
 		else:
 			self.send(RPL.ERRONEUSNICKNAME, 'You cannot change your nick from your auth username.')
 
+	def _registered(self, nick, user, available):
+		if self.disconnected:
+			self.release_claim()
+			return
+		if not user:
+			self.send(RPL.ERRONEUSNICKNAME, 'Invalid nick/password combination.')
+			self.disconnect()
+			return
+		if not available or nick in users: # someone else finished logging in while we were
+			self.send(RPL.ERRONEUSNICKNAME, 'Already a User connected')
+			self.disconnect()
+			return
+		self.real_name = user.entities['character'].name
+		self.user = self.real_name.replace(' ', '_')
+		self.host = user.entities['corporation'].name.replace(' ', '.')
+		self.nick = nick
+		self.source = '%s!%s@%s' % (self.nick, self.user, self.host)
+		self.groups = user.group_names
+		users[self.nick] = self
+
 	def user(self, msg):
 		if not self.nick:
 			self.send(RPL.NOTREGISTERED, 'You have not registered')
@@ -213,9 +352,8 @@ class User:
 		self.send(RPL.MOTD_END, '*** End of message of the day')
 
 		for group in self.groups:
-			if group.name == 'grim sleepers':
-				self._join('#grimsleepers')
-				break
+			for chan_name in auto_join.get(group, ()):
+				self._join(chan_name)
 
 	def mode(self, msg):
 		if not self.nick or not msg.target:
@@ -257,19 +395,26 @@ class User:
 			self.send(RPL.WHOISUSER, user.nick, user.user, user.host, '*', user.real_name)
 			self.send(RPL.ENDOFWHOIS, 'End of WHOIS list')
 		else:
-			try:
-				db_user = db.session.query(db.User).filter(db.User.username==msg.target) \
-						.options(orm.joinedload('character').joinedload('parent')).first()
-				if db_user:
-					real_name = db_user.character.name
-					host = db_user.character.parent.name.replace(' ', '.')
-					user_user = real_name.replace(' ', '_')
-					self.send(RPL.WHOWASUSER, db_user.username, user_user, host, '*', real_name)
-					self.send(RPL.ENDOFWHOWAS, 'End of WHOWAS')
-				else:
-					self.send(RPL.WASNOSUCHNICK, 'There is no user by the name ' + msg.target)
-			finally:
-				db.session.remove()
+			target = msg.target
+			def lookup():
+				try:
+					return db.resolve_users(usernames=[target])
+				finally:
+					db.session.remove()
+			self.defer(lookup, lambda resolved: self._whowas(target, resolved))
+
+	def _whowas(self, target, resolved):
+		if self.disconnected:
+			return
+		if resolved:
+			db_user = resolved[0]
+			real_name = db_user.entities['character'].name
+			host = db_user.entities['corporation'].name.replace(' ', '.')
+			user_user = real_name.replace(' ', '_')
+			self.send(RPL.WHOWASUSER, db_user.username, user_user, host, '*', real_name)
+			self.send(RPL.ENDOFWHOWAS, 'End of WHOWAS')
+		else:
+			self.send(RPL.WASNOSUCHNICK, 'There is no user by the name ' + target)
 
 	def join(self, msg):
 		if not self.nick or not msg.target:
@@ -277,12 +422,9 @@ class User:
 		self._join(msg.target)
 
 	def _join(self, chan_name):
-		if chan_name not in channels:
-			channels[chan_name] = channel = Channel(chan_name)
-		else:
-			channel = channels[chan_name]
-			if channel in self.channels:
-				return
+		channel = get_channel(chan_name)
+		if channel in self.channels:
+			return
 		channel.join(self)
 		self.channels.add(channel)
 
@@ -296,10 +438,24 @@ class User:
 		self.channels.remove(channel)
 
 	def privmsg(self, msg):
-		if not self.nick:
+		if not self.nick or not msg.target or msg.text is None:
 			return
-		channel = channels[msg.target]
-		channel.privmsg(self, msg.text)
+		if msg.target.startswith('#'):
+			channel = channels.get(msg.target)
+			if channel is None:
+				self.send(RPL.NOSUCHCHANNEL, msg.target, 'No such channel')
+			else:
+				channel.privmsg(self, msg.text)
+			return
+		data = format_line('PRIVMSG', msg.text, target=msg.target, source=self.nick)
+		user = users.get(msg.target)
+		if user is not None:
+			user.send_line(data)
+		elif bus is not None:
+			# the hub knows which worker has them, and bounces it back if nobody does
+			bus.publish(op='privmsg', nick=msg.target, sender=self.nick, data=data.decode('utf-8'))
+		else:
+			self.send(RPL.NOSUCHNICK, msg.target, 'No such nick/channel')
 
 	def quit(self, msg):
 		self.disconnect()
@@ -322,79 +478,503 @@ class User:
 		'PONG': pong,
 	}
 
-	def __hash__(self):
-		return hash(self.nick)
-
 class Channel:
+	NAMES_PER_REPLY = 10
+
 	def __init__(self, name):
 		self.name = name
 		self.users = set()
+		self.names = None # NAMREPLY chunks, built on demand and kept until someone leaves
 
-	def join(self, user):
+	def add(self, user):
+		if user in self.users:
+			return
 		self.users.add(user)
-		for u in self.users:
-			if user is u:
-				continue
-			u.send('JOIN', target=self.name, source=user.source)
-		user.send('JOIN', target=self.name, source=user.source)
-
-		names = []
-		for x in self.users:
-			names.append(x.nick)
-			if len(names) == 10:
-				user.send(RPL.NAMREPLY, '@', self.name, ' '.join(names), source=config.irc_host)
-				names.clear()
-
-		if len(names) > 0:
-		    user.send(RPL.NAMREPLY, '@', self.name, ' '.join(names), source=config.irc_host)
+		names = self.names
+		if names is not None:
+			# joins just extend the last chunk; only leaving forces a rebuild
+			if names and len(names[-1]) < self.NAMES_PER_REPLY:
+				names[-1].append(user.nick)
+			else:
+				names.append([user.nick])
+
+	def remove(self, user):
+		self.users.discard(user)
+		self.names = None
+
+	def names_replies(self):
+		if self.names is None:
+			nicks = [u.nick for u in self.users]
+			self.names = [nicks[i:i + self.NAMES_PER_REPLY] for i in range(0, len(nicks), self.NAMES_PER_REPLY)]
+		return self.names
+
+	def join(self, user):
+		self.add(user)
+		data = format_line('JOIN', target=self.name, source=user.source)
+		self.broadcast(data)
+		if bus is not None:
+			bus.publish(op='join', channel=self.name, nick=user.nick, user=user.user, host=user.host,
+					real_name=user.real_name, source=user.source, data=data.decode('utf-8'))
+
+		for names in self.names_replies():
+			user.send(RPL.NAMREPLY, '@', self.name, ' '.join(names), source=config.irc_host)
 		user.send(RPL.ENDOFNAMES, self.name, 'End of /NAMES list')
 
 	def part(self, user):
-		for u in self.users:
-			u.send('PART', target=self.name, source=user.source)
-		self.users.remove(user)
+		data = format_line('PART', target=self.name, source=user.source)
+		self.broadcast(data)
+		self.remove(user)
+		if bus is not None:
+			bus.publish(op='part', channel=self.name, nick=user.nick, data=data.decode('utf-8'))
 
 	def quit(self, user):
-		self.users.remove(user)
-		for u in self.users:
-			if user is u:
-				continue
-			u.send('QUIT', target='', source=user.source)
+		# the other workers get one quit for all channels from User.disconnect
+		self.remove(user)
+		self.broadcast(format_line('QUIT', target='', source=user.source))
 
 	def privmsg(self, user, text):
+		data = format_line('PRIVMSG', text, target=self.name, source=user.nick)
+		self.broadcast(data, exclude=user)
+		if bus is not None:
+			bus.publish(op='line', channel=self.name, data=data.decode('utf-8'))
+
+	def broadcast(self, data, exclude=None):
+		# every member gets the same bytes object; nothing is formatted or encoded per recipient
 		for u in self.users:
-			if user is u:
-				continue
-			u.send('PRIVMSG', text, target=self.name, source=user.nick)
+			if u is not exclude:
+				u.send_line(data)
 
 	def __hash__(self):
 		return hash(self.name)
 
-def ping_all():
-	while True:
-		for user in list(users.values()):
-			user.check_timeout()
-		eventlet.sleep(60)
+def get_channel(name):
+	channel = channels.get(name)
+	if channel is None:
+		channels[name] = channel = Channel(name)
+	return channel
+
+def load_auto_join():
+	''' build auto_join from config.irc_group_channels, once, checking the groups exist '''
+	try:
+		known = {name for name, in db.session.query(db.Group.name)}
+	finally:
+		db.session.remove()
+	auto_join.clear()
+	for group, chan_names in config.irc_group_channels.items():
+		if group not in known:
+			server_log.warning('irc_group_channels: no such group %r', group)
+			continue
+		auto_join[group] = tuple(chan_names)
+
+class RemoteUser:
+	''' a member of our channels connected to another worker; listed by NAMES and WHO, never sent to '''
+	def __init__(self, nick, user, host, real_name, source):
+		self.nick = nick
+		self.user = user
+		self.host = host
+		self.real_name = real_name
+		self.source = source
+		self.channels = set()
+
+	def send_line(self, data):
+		pass
+
+class Bus:
+	''' a worker's link to the hub in the master process, which relays to every other worker '''
+	# one JSON object per line; the other workers' broadcasts arrive already formatted
+	def __init__(self, conn):
+		self.conn = conn
+		self.lines = LineBuffer(max_length=1 << 16)
+
+	def connected(self):
+		self.publish(op='hello', pid=os.getpid())
+
+	def feed(self, data):
+		for line in self.lines.feed(data):
+			if line:
+				message = json.loads(line.decode('utf-8'))
+				getattr(self, 'handle_' + message.pop('op'))(**message)
+
+	def disconnect(self):
+		# the master is gone; without it our channel state can't be trusted
+		bus_log.error('lost the bus, exiting')
+		logging.shutdown()
+		os._exit(1)
+
+	def publish(self, **message):
+		self.conn.write(json.dumps(message).encode('utf-8') + b'\n')
+
+	@staticmethod
+	def claim(nick):
+		''' reserve nick across all workers; blocks, so only call it from a deferred function '''
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(args.bus)
+			sock.sendall(json.dumps({'op': 'claim', 'nick': nick, 'pid': os.getpid()}).encode('utf-8') + b'\n')
+			reply = sock.makefile('rb').readline()
+		return json.loads(reply.decode('utf-8'))['ok']
+
+	def handle_join(self, channel, nick, user, host, real_name, source, data):
+		remote = remote_users.get(nick)
+		if remote is None:
+			remote_users[nick] = remote = RemoteUser(nick, user, host, real_name, source)
+		channel = get_channel(channel)
+		channel.add(remote)
+		remote.channels.add(channel)
+		if data is not None: # None when the hub replays state to a new worker
+			channel.broadcast(data.encode('utf-8'))
+
+	def handle_part(self, channel, nick, data):
+		remote = remote_users.get(nick)
+		channel = channels.get(channel)
+		if remote is not None and channel is not None and remote in channel.users:
+			channel.remove(remote)
+			remote.channels.remove(channel)
+			channel.broadcast(data.encode('utf-8'))
+
+	def handle_quit(self, nick, data):
+		remote = remote_users.pop(nick, None)
+		if remote is not None:
+			for channel in remote.channels:
+				channel.remove(remote)
+				channel.broadcast(data.encode('utf-8'))
+
+	def handle_line(self, channel, data):
+		channel = channels.get(channel)
+		if channel is not None:
+			channel.broadcast(data.encode('utf-8'))
+
+	def handle_privmsg(self, nick, sender, data):
+		user = users.get(nick)
+		if user is not None:
+			user.send_line(data.encode('utf-8'))
+
+	def handle_nosuchnick(self, nick, sender):
+		user = users.get(sender)
+		if user is not None:
+			user.send(RPL.NOSUCHNICK, nick, 'No such nick/channel')
+
+class EventletConnection:
+	''' a socket served by a recv greenlet and a send greenlet '''
+	def __init__(self, sock, addr, protocol=None, sendq_limit=config.irc_sendq_limit):
+		self.sock = sock
+		self.addr = addr
+		self.sendq_limit = sendq_limit
+		self.protocol = (protocol or User)(self)
+		self.recv_greenlet = self.send_greenlet = None
+		self.send_queue = eventlet.queue.LightQueue()
+		self.queued_bytes = 0
+		self.send_queue_full = False
+
+	def serve(self):
+		self.recv_greenlet = eventlet.getcurrent()
+		self.send_greenlet = eventlet.spawn(self.handle_send_queue)
+		self.protocol.connected()
+		while True:
+			try:
+				data = self.sock.recv(4096)
+			except OSError as e:
+				if e.errno in [errno.EBADF, errno.ECONNRESET]:
+					self.protocol.disconnect()
+					break
+				raise
+			if not data:
+				self.protocol.disconnect()
+				break
+			self.protocol.feed(data)
+
+	def handle_send_queue(self):
+		while True:
+			chunks = [self.send_queue.get()]
+			# everything that piled up while we were blocked goes out in one syscall
+			while True:
+				try:
+					chunks.append(self.send_queue.get_nowait())
+				except eventlet.queue.Empty:
+					break
+			data = b''.join(chunks)
+			self.queued_bytes -= len(data)
+			try:
+				self.sock.sendall(data)
+			except OSError as e:
+				if e.errno in [errno.EBADF, errno.ECONNRESET]:
+					self.protocol.disconnect()
+				else:
+					raise
+
+	def write(self, data):
+		if self.send_queue_full:
+			return
+		self.queued_bytes += len(data)
+		if self.sendq_limit is not None and self.queued_bytes > self.sendq_limit:
+			conn_log.warning('send queue limit exceeded for %s', self.addr)
+			self.send_queue_full = True
+			# not inline: we're usually in the middle of iterating over a channel's members
+			eventlet.spawn_n(self.protocol.disconnect)
+			return
+		self.send_queue.put_nowait(data)
+
+	def close(self):
+		current_greenlet = eventlet.getcurrent()
+		for greenlet in [self.recv_greenlet, self.send_greenlet]:
+			# we might be called by serve/quit, handle_send_queue, or check_timeouts/disconnect_all
+			if greenlet is not None and greenlet is not current_greenlet:
+				greenlet.kill()
+		self.sock.close()
+
+	def defer(self, func, callback):
+		# green sockets and tpool hashing already yield to the hub
+		callback(func())
+
+class AsyncioConnection(asyncio.Protocol):
+	''' the same connection contract as EventletConnection, driven by an asyncio event loop '''
+	def __init__(self, loop, protocol=None, sendq_limit=config.irc_sendq_limit):
+		self.loop = loop
+		self.protocol_factory = protocol or User
+		self.sendq_limit = sendq_limit
+		self.transport = self.addr = self.protocol = None
+		self.chunks = []
+		self.queued_bytes = 0
+		self.send_queue_full = False
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.addr = transport.get_extra_info('peername')
+		self.protocol = self.protocol_factory(self)
+		self.protocol.connected()
+
+	def data_received(self, data):
+		self.protocol.feed(data)
+
+	def connection_lost(self, exc):
+		self.protocol.disconnect()
+
+	def write(self, data):
+		if self.send_queue_full:
+			return
+		self.queued_bytes += len(data)
+		if self.sendq_limit is not None and \
+				self.queued_bytes + self.transport.get_write_buffer_size() > self.sendq_limit:
+			conn_log.warning('send queue limit exceeded for %s', self.addr)
+			self.send_queue_full = True
+			self.loop.call_soon(self.protocol.disconnect)
+			return
+		if not self.chunks:
+			self.loop.call_soon(self.flush)
+		self.chunks.append(data)
+
+	def flush(self):
+		# everything written during this loop iteration goes out in one write
+		data = b''.join(self.chunks)
+		self.chunks.clear()
+		self.queued_bytes = 0
+		if not self.transport.is_closing():
+			self.transport.write(data)
+
+	def close(self):
+		# a reply written just before closing (a login error, say) must still go out;
+		# transport.close() sends what's in its buffer but not what's still in ours
+		if self.chunks:
+			self.flush()
+		self.transport.close()
+
+	def defer(self, func, callback):
+		def done(future):
+			try:
+				result = future.result()
+			except Exception:
+				conn_log.exception('deferred call failed for %s', self.addr)
+				self.protocol.disconnect()
+				return
+			callback(result)
+		self.loop.run_in_executor(None, func).add_done_callback(done)
+
+class Hub:
+	''' runs in the master: owns nick reservations and channel membership, relays between workers '''
+	def __init__(self):
+		self.workers = {} # pid -> HubPeer
+		self.nicks = {} # nick -> pid
+		self.joins = {} # channel -> {nick: join message}
+
+	def handle(self, peer, message):
+		op = message['op']
+		if op == 'hello':
+			peer.pid = message['pid']
+			self.workers[peer.pid] = peer
+			# a new worker learns who is already in each channel without re-announcing them
+			for joins in self.joins.values():
+				for join in joins.values():
+					peer.send(dict(join, data=None))
+		elif op == 'claim':
+			ok = message['nick'] not in self.nicks
+			if ok:
+				self.nicks[message['nick']] = message['pid']
+			peer.send({'op': 'claimed', 'ok': ok})
+		elif op == 'release':
+			# only the worker holding the claim can give it up
+			if self.nicks.get(message['nick']) == peer.pid:
+				del self.nicks[message['nick']]
+		elif op == 'privmsg':
+			target = self.workers.get(self.nicks.get(message['nick']))
+			if target is not None:
+				target.send(message)
+			else:
+				peer.send({'op': 'nosuchnick', 'nick': message['nick'], 'sender': message['sender']})
+		else:
+			if op == 'join':
+				self.joins.setdefault(message['channel'], {})[message['nick']] = message
+			elif op == 'part':
+				self.joins.get(message['channel'], {}).pop(message['nick'], None)
+			elif op == 'quit':
+				self.nicks.pop(message['nick'], None)
+				for joins in self.joins.values():
+					joins.pop(message['nick'], None)
+			self.relay(peer, message)
+
+	def relay(self, sender, message):
+		for peer in self.workers.values():
+			if peer is not sender:
+				peer.send(message)
+
+	def drop(self, peer):
+		if self.workers.get(peer.pid) is not peer:
+			return # a claim connection closing
+		del self.workers[peer.pid]
+		bus_log.warning('worker %s went away', peer.pid)
+		# everyone on that worker quits
+		for nick, pid in list(self.nicks.items()):
+			if pid != peer.pid:
+				continue
+			del self.nicks[nick]
+			source = None
+			for joins in self.joins.values():
+				join = joins.pop(nick, None)
+				if join is not None:
+					source = join['source']
+			if source is not None:
+				data = format_line('QUIT', target='', source=source).decode('utf-8')
+				self.relay(peer, {'op': 'quit', 'nick': nick, 'data': data})
+
+class HubPeer:
+	''' one connection to the hub: a worker's bus, or a short-lived nick claim '''
+	def __init__(self, hub, conn):
+		self.hub = hub
+		self.conn = conn
+		self.pid = None
+		self.lines = LineBuffer(max_length=1 << 16)
+
+	def connected(self):
+		pass
+
+	def feed(self, data):
+		for line in self.lines.feed(data):
+			if line:
+				self.hub.handle(self, json.loads(line.decode('utf-8')))
+
+	def disconnect(self):
+		self.hub.drop(self)
+
+	def send(self, message):
+		self.conn.write(json.dumps(message).encode('utf-8') + b'\n')
+
+def serve_workers(args):
+	''' run the hub and keep args.workers worker processes alive '''
+	path = config.irc_bus_path
+	if os.path.exists(path):
+		os.unlink(path)
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	hub = Hub()
+	loop.run_until_complete(loop.create_unix_server(
+			lambda: AsyncioConnection(loop, lambda conn: HubPeer(hub, conn), sendq_limit=None), path))
+
+	command = [sys.executable, os.path.abspath(__file__), '--core', args.core, '--port', str(args.port),
+			'--workers', '1', '--bus', path]
+	if args.database:
+		command += ['--database', args.database]
+	workers = [subprocess.Popen(command) for _ in range(args.workers)]
+	def check_workers():
+		for i, worker in enumerate(workers):
+			if worker.poll() is not None:
+				server_log.warning('worker %s exited with %s - restarting it', worker.pid, worker.returncode)
+				workers[i] = subprocess.Popen(command)
+		loop.call_later(1, check_workers)
+	loop.call_later(1, check_workers)
+
+	try:
+		loop.run_forever()
+	finally:
+		for worker in workers:
+			worker.terminate()
+		for worker in workers:
+			worker.wait()
+		os.unlink(path)
+
+def check_timeouts():
+	for user in timers.advance():
+		user.check_timeout()
 
 def disconnect_all():
-	print('closing all connections')
+	server_log.info('closing all connections')
 	for user in list(users.values()):
-		user.recv_greenlet.kill()
 		user.disconnect()
 
-def main():
+def serve_eventlet(port):
+	global bus
+	if args.bus:
+		bus_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		bus_sock.connect(args.bus)
+		bus_conn = EventletConnection(bus_sock, args.bus, Bus, sendq_limit=None)
+		bus = bus_conn.protocol
+		eventlet.spawn(bus_conn.serve)
+
 	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 	s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-	s.bind((config.irc_host, 6667))
-	s.listen(4)
+	if args.bus:
+		# the kernel spreads new connections across the workers
+		s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	s.bind((config.irc_host, port))
+	s.listen(128)
 
-	eventlet.spawn(ping_all)
-	atexit.register(disconnect_all)
+	def timeout_loop():
+		while True:
+			eventlet.sleep(1)
+			check_timeouts()
+	eventlet.spawn(timeout_loop)
 
 	while True:
-		conn, addr = s.accept()
-		user = User(conn, addr)
-		eventlet.spawn(user.handle_conn)
+		sock, addr = s.accept()
+		conn = EventletConnection(sock, addr)
+		eventlet.spawn(conn.serve)
+
+def serve_asyncio(port):
+	global bus
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	if args.bus:
+		_, bus_conn = loop.run_until_complete(loop.create_unix_connection(
+				lambda: AsyncioConnection(loop, Bus, sendq_limit=None), args.bus))
+		bus = bus_conn.protocol
+	loop.run_until_complete(loop.create_server(lambda: AsyncioConnection(loop),
+			config.irc_host or None, port, reuse_address=True, reuse_port=bool(args.bus), backlog=128))
+
+	def timeout_loop():
+		check_timeouts()
+		loop.call_later(1, timeout_loop)
+	loop.call_later(1, timeout_loop)
+
+	loop.run_forever()
+
+def main():
+	ircd_log.setup()
+	if args.workers > 1:
+		serve_workers(args)
+		return
+	load_auto_join()
+	atexit.register(disconnect_all)
+	if args.core == 'eventlet':
+		serve_eventlet(args.port)
+	else:
+		serve_asyncio(args.port)
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# load tests ./ircd.py:
+#   ./ircd_loadtest.py full --database outlauth_loadtest --clients 500
+#       seeds a throwaway database (created and initialised beforehand with db.py init),
+#       then measures logins, JOIN, PRIVMSG fan-out and latency percentiles
+#   ./ircd_loadtest.py idle --clients 5000  idle connections per core: memory and round trips
+
+import argparse
+import asyncio
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+PASSWORD = 'loadtest'
+CHANNEL = '#loadtest'
+
+def rss_kb(pid):
+	with open('/proc/%d/status' % pid) as f:
+		for line in f:
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1])
+
+def percentiles(samples):
+	samples = sorted(samples)
+	if not samples:
+		return 'no samples'
+	def at(p):
+		return samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+	return 'p50 %.1fms  p90 %.1fms  p99 %.1fms  max %.1fms' % (at(0.5), at(0.9), at(0.99), samples[-1] * 1000)
+
+def start_server(core, port, database=None):
+	command = [sys.executable, 'ircd.py', '--core', core, '--port', str(port)]
+	if database:
+		command += ['--database', database]
+	proc = subprocess.Popen(command,
+			cwd=os.path.dirname(os.path.abspath(__file__)),
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	deadline = time.monotonic() + 10
+	while True:
+		try:
+			socket.create_connection(('127.0.0.1', port), timeout=1).close()
+			return proc
+		except OSError:
+			if proc.poll() is not None or time.monotonic() > deadline:
+				proc.kill()
+				raise RuntimeError('ircd --core %s did not start' % core)
+			time.sleep(0.1)
+
+def stop_server(proc):
+	proc.terminate()
+	proc.wait()
+
+class Client:
+	''' one simulated user; a reader task records what arrives '''
+	def __init__(self, nick, reader, writer):
+		self.nick = nick
+		self.reader = reader
+		self.writer = writer
+		self.registered = asyncio.Event()
+		self.joined = asyncio.Event()
+		self.latencies = []
+		self.received = 0
+		self.task = asyncio.ensure_future(self.read())
+
+	async def read(self):
+		while True:
+			line = await self.reader.readline()
+			if not line:
+				return
+			parts = line.split(b' ', 3)
+			if parts[0] == b'376': # end of MOTD: USER has been answered
+				self.registered.set()
+			elif parts[0] == b'366': # end of NAMES
+				self.joined.set()
+			elif len(parts) == 4 and parts[1] == b'PRIVMSG':
+				sent_at = float(parts[3].lstrip(b':').split(b' ', 1)[0])
+				self.latencies.append(time.perf_counter() - sent_at)
+				self.received += 1
+
+	def send(self, line):
+		self.writer.write(line.encode('utf-8') + b'\r\n')
+
+	def close(self):
+		self.task.cancel()
+		self.writer.close()
+
+async def connect(port, nick):
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	return Client(nick, reader, writer)
+
+async def register(port, nick, latencies):
+	start = time.perf_counter()
+	client = await connect(port, nick)
+	client.send('PASS %s' % PASSWORD)
+	client.send('NICK %s' % nick)
+	client.send('USER %s 0 * :%s' % (nick, nick))
+	await client.registered.wait()
+	latencies.append(time.perf_counter() - start)
+	return client
+
+async def full(core, port, database, count, messages, concurrency):
+	proc = start_server(core, port, database)
+	clients = []
+	try:
+		# connect + PASS/NICK/USER, a limited number at a time like a reconnect storm
+		auth_latencies = []
+		semaphore = asyncio.Semaphore(concurrency)
+		async def limited(i):
+			async with semaphore:
+				clients.append(await register(port, 'seed_%d' % i, auth_latencies))
+		start = time.perf_counter()
+		await asyncio.gather(*(limited(i) for i in range(count)))
+		auth_elapsed = time.perf_counter() - start
+
+		for client in clients:
+			client.send('JOIN %s' % CHANNEL)
+		await asyncio.gather(*(client.joined.wait() for client in clients))
+
+		# every message reaches every other member
+		expected = messages * (count - 1)
+		start = time.perf_counter()
+		for i in range(messages):
+			random.choice(clients).send('PRIVMSG %s :%.6f %d' % (CHANNEL, time.perf_counter(), i))
+			if i % 100 == 0:
+				await asyncio.sleep(0)
+		deadline = time.monotonic() + 60
+		while sum(client.received for client in clients) < expected and time.monotonic() < deadline:
+			await asyncio.sleep(0.01)
+		fanout_elapsed = time.perf_counter() - start
+		delivered = sum(client.received for client in clients)
+
+		print('core %s, %d clients' % (core, count))
+		print('  connect+auth  %s  (%.0f logins/s)' % (percentiles(auth_latencies), count / auth_elapsed))
+		print('  fan-out       %s' % percentiles([l for client in clients for l in client.latencies]))
+		print('  throughput    %d/%d deliveries in %.2fs, %.0f/s' % (delivered, expected, fanout_elapsed,
+				delivered / fanout_elapsed))
+		print('  server RSS    %dKB' % rss_kb(proc.pid))
+	finally:
+		for client in clients:
+			client.close()
+		stop_server(proc)
+
+async def idle(core, port, count, rounds):
+	proc = start_server(core, port)
+	try:
+		await asyncio.sleep(0.5)
+		idle_rss = rss_kb(proc.pid)
+		connections = []
+		for _ in range(count):
+			connections.append(await asyncio.open_connection('127.0.0.1', port))
+		await asyncio.sleep(0.5)
+		loaded_rss = rss_kb(proc.pid)
+
+		# an unknown command costs the server a parse, a dispatch and a reply, and needs no database
+		async def round_trip(reader, writer):
+			for _ in range(rounds):
+				writer.write(b'LOADTEST\r\n')
+				await reader.readline()
+		start = time.perf_counter()
+		await asyncio.gather(*(round_trip(reader, writer) for reader, writer in connections))
+		rate = count * rounds / (time.perf_counter() - start)
+		for _, writer in connections:
+			writer.close()
+
+		print('%-10s idle %dKB, %d clients %dKB (%.1fKB/client), %.0f round trips/s' % (core, idle_rss, count,
+				loaded_rss, (loaded_rss - idle_rss) / count, rate))
+	finally:
+		stop_server(proc)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('scenario', choices=['full', 'idle'])
+	parser.add_argument('--clients', type=int, default=500)
+	parser.add_argument('--messages', type=int, default=200)
+	parser.add_argument('--rounds', type=int, default=20)
+	parser.add_argument('--concurrency', type=int, default=50, help='logins in flight at once')
+	parser.add_argument('--port', type=int, default=16667)
+	parser.add_argument('--cores', nargs='+', default=['eventlet', 'asyncio'])
+	parser.add_argument('--database', help='throwaway database for full to seed; never config.database')
+	args = parser.parse_args()
+
+	# every client is a descriptor on both ends
+	_, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	if args.scenario == 'idle':
+		for core in args.cores:
+			loop.run_until_complete(idle(core, args.port, args.clients, args.rounds))
+		return
+
+	# seeding commits users with a known password, so it must never touch the live database
+	import config
+	if not args.database:
+		parser.error('full needs --database, a throwaway database initialised with db.py init')
+	if args.database == config.database:
+		parser.error('--database must not be config.database')
+	config.database = args.database # before db is imported
+	import db
+	db.unseed_db() # whatever an interrupted run left behind
+	db.seed_db(args.clients, PASSWORD)
+	db.session.commit()
+	try:
+		for core in args.cores:
+			loop.run_until_complete(full(core, args.port, args.database,
+					args.clients, args.messages, args.concurrency))
+	finally:
+		db.unseed_db()
+		db.session.commit()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,93 @@
+import collections
+import logging
+import queue
+import signal
+import sys
+
+try:
+	import eventlet.patcher
+except ImportError:
+	eventlet = None
+
+import config
+
+if eventlet is not None:
+	# the writer has to be a real OS thread even after monkey_patch() so its writes never block the hub
+	threading = eventlet.patcher.original('threading')
+else:
+	import threading
+
+FORMAT = '%(asctime)s %(process)d %(name)s %(levelname)s %(message)s'
+CATEGORIES = ['server', 'conn', 'proto', 'bus']
+
+class RingHandler(logging.Handler):
+	''' the last few records, kept unformatted until someone asks for them '''
+	def __init__(self, size):
+		super().__init__()
+		self.records = collections.deque(maxlen=size)
+
+	def emit(self, record):
+		self.records.append(record)
+
+	def dump(self, stream):
+		stream.write(''.join(self.format(record) + '\n' for record in list(self.records)))
+		stream.flush()
+
+class BatchWriter(logging.Handler):
+	''' queues records for a background thread that formats and writes whatever has piled up at once '''
+	def __init__(self, stream):
+		super().__init__()
+		self.stream = stream
+		self.queue = queue.SimpleQueue()
+		self.thread = threading.Thread(target=self.run, name='ircd log writer', daemon=True)
+		self.thread.start()
+
+	def emit(self, record):
+		self.queue.put(record)
+
+	def run(self):
+		while True:
+			records = [self.queue.get()]
+			while True:
+				try:
+					records.append(self.queue.get_nowait())
+				except queue.Empty:
+					break
+			lines = [self.format(record) + '\n' for record in records if record is not None]
+			try:
+				self.stream.write(''.join(lines))
+				self.stream.flush()
+			except Exception:
+				pass # nowhere left to report it
+			if None in records:
+				return
+
+	def close(self):
+		# called by logging.shutdown at exit; wait for everything queued so far to be written
+		if self.thread.is_alive():
+			self.queue.put(None)
+			self.thread.join()
+		super().close()
+
+ring = None
+
+def setup():
+	''' route the ircd.* loggers to the ring and the writer, gated by config.irc_log_levels '''
+	global ring
+	formatter = logging.Formatter(FORMAT)
+	ring = RingHandler(config.irc_log_ring)
+	if config.irc_log_path:
+		stream = open(config.irc_log_path, 'a')
+	else:
+		stream = sys.stderr
+	writer = BatchWriter(stream)
+	root = logging.getLogger('ircd')
+	root.propagate = False
+	for handler in [ring, writer]:
+		handler.setFormatter(formatter)
+		root.addHandler(handler)
+	for category in CATEGORIES:
+		level = config.irc_log_levels.get(category, 'INFO')
+		logging.getLogger('ircd.' + category).setLevel(level)
+	# kill -USR1 shows recent activity even when the log file isn't being watched
+	signal.signal(signal.SIGUSR1, lambda signum, frame: ring.dump(sys.stderr))
@@ -1,13 +1,11 @@
 #!/usr/bin/env python3
 
-import operator
 import random
 
 import Ice
 Ice.loadSlice('-I/usr/share/Ice/slice', ['/usr/share/slice/Murmur.ice'])
 import Murmur
 import raven
-from sqlalchemy.orm.exc import NoResultFound
 
 import config
 import db
@@ -19,18 +17,13 @@ class Authenticator(Murmur.ServerAuthenticator):
 			if name == 'raylu-bot' and pw == 'bot':
 				return 999999999, new_name, ['grim sleepers']
 
-			try:
-				db.session.query(db.User).filter(db.User.username==name).one()
-			except NoResultFound:
+			user = db.authenticate(name, pw)
+			if user is None:
 				return -2, new_name, [] # guest
-
-			user = db.User.login(name, pw)
 			if not user:
 				return -1, new_name, [] # bad password for registered user
 
-			entities = user.entities()
-			groups = user.groups(entities)
-			group_names = list(map(operator.attrgetter('name'), groups))
+			group_names = list(user.group_names)
 			if user.flags == 1:
 				group_names.append('admin')
 			return user.id, new_name, group_names # regular login
@@ -3,17 +3,21 @@
 import eventlet
 eventlet.monkey_patch()
 
-from collections import defaultdict
+import datetime
 from functools import wraps
+import hashlib
 import operator
 import os
 import string
+import sys
+import time
 
 import cleancss
 import eventlet.wsgi
 import flask
 from flask import request, session
 import sqlalchemy.exc
+from sqlalchemy.orm import subqueryload
 
 import ccp_pls
 import config
@@ -28,9 +32,10 @@ flask.Response.autocorrect_location_header = False
 def home():
 	user = entities = groups = None
 	if 'user_id' in session:
-		user = get_current_user()
-		entities = user.entities()
-		groups = user.groups(entities)
+		user = get_session_user()
+		if user is not None:
+			entities = user.entities
+			groups = user.group_names
 	return flask.render_template('home.html', user=user, entities=entities, groups=groups)
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -83,7 +88,7 @@ def register():
 			try:
 				db.session.commit()
 			except sqlalchemy.exc.DBAPIError as e:
-				if e.orig.code == '23505': # unique_violation
+				if db.error_code(e) == '23505': # unique_violation
 					flask.flash('Username or email already exists.')
 					return step_2()
 				else:
@@ -98,7 +103,7 @@ def login():
 	if request.method == 'GET':
 		return flask.render_template('login.html')
 	else:
-		user = db.User.login(request.form['username'], request.form['password'])
+		user = db.authenticate(request.form['username'], request.form['password'])
 		if user:
 			session['user_id'] = user.id
 			return flask.redirect(flask.url_for('home'))
@@ -115,12 +120,16 @@ def account():
 	if request.method == 'GET':
 		return flask.render_template('account.html', user=user)
 	else:
+		old_username = user.username
 		user.username = request.form['username']
 		if request.form['password']:
 			user.password, user.salt = db.User.hash_pw(request.form['password'])
 		user.apikey_id = int(request.form['apikey_id'])
 		user.apikey_vcode = request.form['apikey_vcode']
 		db.session.commit()
+		# after the commit, so a login racing with it can't cache the old row again
+		db.credential_cache.invalidate([old_username])
+		db.user_cache.invalidate([user.id])
 		return flask.redirect(flask.url_for('account'))
 
 @app.route('/logout')
@@ -136,7 +145,9 @@ def admin_route(route): # decorator
 	def wrapped(*args, **kwargs):
 		if 'user_id' not in session:
 			return flask.redirect(flask.url_for('login'))
-		user = get_current_user()
+		user = get_session_user()
+		if user is None:
+			return flask.redirect(flask.url_for('login'))
 		if user.flags != 1:
 			flask.abort(403)
 		return route(*args, **kwargs)
@@ -154,6 +165,7 @@ def admins():
 def admins_add(id):
 	db.session.query(db.User).filter(db.User.id==int(id)).update({'flags': 1})
 	db.session.commit()
+	db.user_cache.invalidate([int(id)])
 	return flask.redirect(flask.url_for('admins'))
 
 @app.route('/admins/remove/<id>')
@@ -161,15 +173,16 @@ def admins_add(id):
 def admins_remove(id):
 	db.session.query(db.User).filter(db.User.id==int(id)).update({'flags': 0})
 	db.session.commit()
+	db.user_cache.invalidate([int(id)])
 	return flask.redirect(flask.url_for('admins'))
 
 @app.route('/groups', methods=['GET', 'POST'])
 @admin_route
 def groups():
 	if request.method == 'GET':
-		entities = db.session.query(db.Entity)
-		groups = db.session.query(db.Group)
-		return flask.render_template('groups.html', entities=entities, groups=groups)
+		# the entity picker is filled from /groups/entities
+		groups = db.session.query(db.Group).options(subqueryload('members'))
+		return flask.render_template('groups.html', groups=groups)
 	else:
 		group_id = int(request.form['group'])
 		gm = db.group_membership
@@ -184,96 +197,172 @@ def groups():
 		if to_delete:
 			db.session.execute(gm.delete().where(
 					gm.columns['group_id']==group_id).where(gm.columns['entity_id'].in_(to_delete)))
+		if to_insert or to_delete:
+			# members may be corporations or alliances, so any character can be affected
+			db.refresh_effective_groups()
 		db.session.commit()
+		if to_insert or to_delete:
+			# after the commit, so a page view racing with it can't cache the old groups again
+			db.user_cache.invalidate()
 		return flask.redirect(flask.url_for('groups'))
 
+@app.route('/groups/entities')
+@admin_route
+def group_entities():
+	limit = 50
+	after = None
+	if 'after_id' in request.args:
+		after = (request.args['after_key'], int(request.args['after_id']))
+	results = db.search_entities(request.args.get('q', ''), after, limit)
+	next_page = None
+	if len(results) == limit:
+		key, entity = results[-1]
+		next_page = {'after_key': key, 'after_id': entity.id}
+	entities = [entity._asdict() for _, entity in results]
+	return flask.jsonify(entities=entities, next=next_page)
+
+CONTACTS_PER_PAGE = 100
+
 @app.route('/contacts', methods=['GET', 'POST'])
 @admin_route
 def contacts():
 	if request.method == 'GET':
-		contact_list = db.session.query(db.Contact)
-		return flask.render_template('contacts.html', contacts=contact_list)
+		q = request.args.get('q', '')
+		try:
+			page = max(int(request.args.get('page', 1)), 1)
+		except ValueError:
+			page = 1
+		query = db.session.query(db.Contact)
+		if q:
+			query = query.filter(db.Contact.name.ilike('%' + q.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_') + '%'))
+		# one extra row tells us whether there's a next page without a COUNT
+		contact_list = query.order_by(db.Contact.name, db.Contact.id) \
+				.offset((page - 1) * CONTACTS_PER_PAGE).limit(CONTACTS_PER_PAGE + 1).all()
+		has_next = len(contact_list) > CONTACTS_PER_PAGE
+		return flask.render_template('contacts.html', contacts=contact_list[:CONTACTS_PER_PAGE],
+				q=q, page=page, has_next=has_next)
 	elif request.method == 'POST':
 		save_contacts(request.form)
-		return flask.redirect(flask.url_for('contacts'))
+		return flask.redirect(flask.url_for('contacts', **request.args.to_dict()))
 
 def save_contacts(form):
-	form_contacts = defaultdict(list)
-	changed = []
-	for contact in form:
-		form_contacts[int(contact)].append(form[contact])
-	for contact in db.session.query(db.Contact):
-		if form_contacts[contact.id][0] != contact.comments:
-			changed.append(db.Contact(
-				id=contact.id,
-				name=contact.name,
-				standing=contact.standing,
-				type_id=contact.type_id,
-				comments=form_contacts[contact.id][0],
-			))
-
-	for contact in changed:
-		db.session.merge(db.Contact(
-			id=int(contact.id),
-			comments=contact.comments,
-		))
+	''' update the comments of the submitted contacts that actually changed, in one statement '''
+	submitted = {int(key): value for key, value in form.items() if key.isdigit()}
+	if not submitted:
+		return
+	current = db.session.query(db.Contact.id, db.Contact.comments).filter(db.Contact.id.in_(submitted))
+	changed = [{'contact_id': contact_id, 'new_comments': submitted[contact_id]}
+			for contact_id, comments in current if (comments or '') != submitted[contact_id]]
+	if changed:
+		contacts = db.Contact.__table__
+		db.session.execute(contacts.update()
+				.where(contacts.c.id == sqlalchemy.bindparam('contact_id'))
+				.values(comments=sqlalchemy.bindparam('new_comments')), changed)
 	db.session.commit()
 
 @app.route('/update_contacts', methods=(['POST']))
+@admin_route
 def update_contacts():
 	user = get_current_user()
+	start = time.perf_counter()
 	api_contacts = ccp_pls.alliance_contact_list(user.apikey_id, user.apikey_vcode, user.character_id)
 	if api_contacts is None:
 		return flask.redirect(flask.url_for('contacts'))
-
-	api_standings = {}
-	for contact in api_contacts:
-		api_standings[contact['id']] = db.Contact(
-			id=contact['id'],
-			name=contact['contact_name'],
-			standing=contact['standing'],
-			type_id=contact['type_id']
-		)
-
-	changed = []
-	removed = []
-	for contact in db.session.query(db.Contact):
-		try:
-			api_standing = api_standings[contact.id].standing
-		except KeyError:
-			removed.append(contact)
-		else:
-			if contact.standing != api_standing:
-				contact.standing = api_standing
-				changed.append(contact)
-			del api_standings[contact.id]
-
-	db.session.add_all(api_standings.values())
-	for contact in changed:
-		db.session.merge(api_standings[contact.id])
-	for contact in removed:
-		db.session.delete(contact)
+	fetched = time.perf_counter()
+
+	# one pass over what we have: whatever the API didn't mention is left to delete
+	existing = dict(db.session.query(db.Contact.id, db.Contact.standing))
+	inserts = []
+	updates = []
+	for contact_id, (name, standing, type_id) in api_contacts.items():
+		old_standing = existing.pop(contact_id, None)
+		if old_standing is None:
+			inserts.append({'id': contact_id, 'name': name, 'standing': standing, 'type_id': type_id})
+		elif old_standing != standing:
+			updates.append({'contact_id': contact_id, 'new_standing': standing})
+	deletes = list(existing)
+	diffed = time.perf_counter()
+
+	contacts = db.Contact.__table__
+	if inserts:
+		db.session.execute(contacts.insert(), inserts)
+	if updates:
+		db.session.execute(contacts.update()
+				.where(contacts.c.id == sqlalchemy.bindparam('contact_id'))
+				.values(standing=sqlalchemy.bindparam('new_standing')), updates)
+	if deletes:
+		db.session.execute(contacts.delete().where(contacts.c.id.in_(deletes)))
 	db.session.commit()
+	applied = time.perf_counter()
 
+	flask.flash('%d added, %d changed, %d removed (fetch %.0f ms, diff %.0f ms, write %.0f ms)' % (
+		len(inserts), len(updates), len(deletes),
+		(fetched - start) * 1000, (diffed - fetched) * 1000, (applied - diffed) * 1000))
 	return flask.redirect(flask.url_for('contacts'))
 
+@app.route('/stats')
+@admin_route
+def stats():
+	return flask.jsonify(api_cache=ccp_pls.response_cache.stats(),
+			users=db.user_cache.stats(), credentials=db.credential_cache.stats(), db_pool=db.engine.pool.stats())
+
 def get_current_user():
-	return db.session.query(db.User).get(session['user_id'])
+	''' the logged-in db.User, for views that change it; loaded at most once per request '''
+	if 'current_user' not in flask.g:
+		flask.g.current_user = db.session.query(db.User).get(session['user_id'])
+	return flask.g.current_user
+
+def get_session_user():
+	''' the logged-in db.ResolvedUser (or None), usually straight from db.user_cache '''
+	if 'session_user' not in flask.g:
+		flask.g.session_user = db.user_cache.get(session['user_id'])
+	return flask.g.session_user
 
 css_path = os.path.join(os.path.dirname(__file__), 'static', 'css')
+css_cache = {} # root -> (mtime, etag, css)
+def compile_css(root):
+	abs_path = os.path.join(css_path, root) + '.ccss'
+	mtime = os.path.getmtime(abs_path)
+	cached = css_cache.get(root)
+	if cached is None or cached[0] != mtime:
+		with open(abs_path, 'r') as f:
+			compiled = cleancss.convert(f)
+		etag = hashlib.sha1(compiled.encode('utf-8')).hexdigest()
+		cached = css_cache[root] = (mtime, etag, compiled)
+	return cached
+
 @app.route('/css/<filename>')
 def css(filename):
 	root, _ = os.path.splitext(filename)
-	abs_path = os.path.join(css_path, root) + '.ccss'
-	with open(abs_path, 'r') as f:
-		return cleancss.convert(f), 200, {'Content-Type': 'text/css'}
+	try:
+		mtime, etag, compiled = compile_css(root)
+	except FileNotFoundError:
+		flask.abort(404)
+	response = flask.Response(compiled, mimetype='text/css')
+	response.set_etag(etag)
+	response.last_modified = datetime.datetime.utcfromtimestamp(int(mtime))
+	response.cache_control.no_cache = True # always revalidate; a 304 is cheap
+	return response.make_conditional(request)
+
+def build_css():
+	''' write static/css/*.css so production can serve them without this app '''
+	for filename in os.listdir(css_path):
+		root, ext = os.path.splitext(filename)
+		if ext != '.ccss':
+			continue
+		_, _, compiled = compile_css(root)
+		with open(os.path.join(css_path, root) + '.css', 'w') as f:
+			f.write(compiled)
 
 @app.teardown_appcontext
 def shutdown_session(exception=None):
 	db.session.remove()
 
-if config.debug:
-	app.run(host=config.web_host, port=config.web_port, debug=True)
-else:
-	listener = eventlet.listen((config.web_host, config.web_port))
-	eventlet.wsgi.server(listener, app)
+if __name__ == '__main__':
+	if sys.argv[1:] == ['build_css']:
+		build_css()
+	elif config.debug:
+		app.run(host=config.web_host, port=config.web_port, debug=True)
+	else:
+		listener = eventlet.listen((config.web_host, config.web_port))
+		eventlet.wsgi.server(listener, app)
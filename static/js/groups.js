@@ -1,28 +1,65 @@
 window.addEvent('domready', function() {
 	'use strict';
 
-	var groupSelects = $$('.hidden');
+	var groupSelects = $$('select.group');
 	var entitiesSelect = $('entities');
-	var entityOptions = entitiesSelect.getChildren('option');
+	var searchInput = $('search');
+	var moreButton = $('more');
 	var currentGroup = null;
+	var nextPage = null;
+	var searchTimer = null;
 
-	function showGroup(groupId) {
-		groupSelects.addClass('hidden');
-
-		var groupSelect = $('group_' + groupId);
+	function addEntities(entities) {
 		var members = {};
-		groupSelect.getChildren('option').each(function(option) {
+		currentGroup.getChildren('option').each(function(option) {
 			members[option.value] = true;
 		});
-		entitiesSelect.empty();
-		entityOptions.each(function(entity) {
-			if (!(entity.value in members)) {
-				entitiesSelect.grab(entity);
+		entities.each(function(entity) {
+			if (!(entity.id in members)) {
+				entitiesSelect.grab(new Element('option', {
+					'value': entity.id,
+					'text': entity.name + ' (' + entity.type + ')',
+				}));
 			}
 		});
+	}
+
+	var request = new Request.JSON({
+		'url': '/groups/entities',
+		'method': 'get',
+		'link': 'cancel',
+		'onSuccess': function(response) {
+			addEntities(response.entities);
+			nextPage = response.next;
+			if (nextPage) {
+				moreButton.removeClass('hidden');
+			} else {
+				moreButton.addClass('hidden');
+			}
+		},
+	});
 
-		groupSelect.removeClass('hidden');
-		currentGroup = groupSelect;
+	function search() {
+		entitiesSelect.empty();
+		nextPage = null;
+		request.send({'data': {'q': searchInput.value}});
+	}
+	searchInput.addEvent('input', function() {
+		clearTimeout(searchTimer);
+		searchTimer = search.delay(200);
+	});
+	moreButton.addEvent('click', function(e) {
+		e.preventDefault();
+		if (nextPage) {
+			request.send({'data': Object.merge({'q': searchInput.value}, nextPage)});
+		}
+	});
+
+	function showGroup(groupId) {
+		groupSelects.addClass('hidden');
+		currentGroup = $('group_' + groupId);
+		currentGroup.removeClass('hidden');
+		search();
 	}
 	$('group').addEvent('change', function(e) {
 		var groupId = e.target.value;
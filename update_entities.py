@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
-import time
+import concurrent.futures
+from xml.etree import ElementTree
+
+import requests
+from sqlalchemy.dialects.postgresql import insert
 
 import ccp_pls
+import config
 import db
 
 def check_api_key(key_id, vcode):
@@ -17,45 +22,92 @@ def check_api_key(key_id, vcode):
 
 	return key_info
 
-def update_for_char(char):
-	if char['alliance_id']:
-		db.session.merge(db.Entity(
-			id=char['alliance_id'], type='alliance', name=char['alliance_name']))
-		db.session.commit()
-
-	corporation = db.Entity(
-		id=char['corporation_id'], type='corporation', name=char['corporation_name'])
-	if char['alliance_id']:
-		corporation.parent_id = char['alliance_id']
-	db.session.merge(corporation)
-	db.session.commit()
+class EntityBatch:
+	''' alliance/corporation/character rows from many characters, one row per entity '''
+	# parents are written before children so every chunk's foreign keys already exist
+	type_order = {'alliance': 0, 'corporation': 1, 'character': 2}
+
+	def __init__(self):
+		self.rows = {}
+
+	def add_char(self, char):
+		alliance_id = char['alliance_id'] or None
+		if alliance_id:
+			self.rows[alliance_id] = {'id': alliance_id, 'type': 'alliance',
+					'name': char['alliance_name'], 'parent_id': None}
+		self.rows[char['corporation_id']] = {'id': char['corporation_id'], 'type': 'corporation',
+				'name': char['corporation_name'], 'parent_id': alliance_id}
+		self.rows[char['character_id']] = {'id': char['character_id'], 'type': 'character',
+				'name': char['character_name'], 'parent_id': char['corporation_id']}
 
-	db.session.merge(db.Entity(
-		id=char['character_id'], type='character',
-		name=char['character_name'], parent_id=char['corporation_id']))
+	def flush(self, chunk_size=1000):
+		rows = sorted(self.rows.values(), key=lambda row: self.type_order[row['type']])
+		table = db.Entity.__table__
+		for i in range(0, len(rows), chunk_size):
+			stmt = insert(table).values(rows[i:i+chunk_size])
+			stmt = stmt.on_conflict_do_update(index_elements=[table.c.id], set_={
+				'type': stmt.excluded.type,
+				'name': stmt.excluded.name,
+				'parent_id': stmt.excluded.parent_id,
+			})
+			db.session.execute(stmt)
+		self.rows.clear()
+
+def update_for_char(char):
+	batch = EntityBatch()
+	batch.add_char(char)
+	batch.flush()
+	db.refresh_effective_groups([char['character_id']])
 	db.session.commit()
+	db.user_cache.invalidate(character_ids=[char['character_id']])
 
 class InvalidAPI(Exception):
 	def __init__(self, message):
 		self.message = message
 
+def fetch_key_info(user):
+	try:
+		return check_api_key(user.apikey_id, user.apikey_vcode)
+	except InvalidAPI as e:
+		return e
+
 def main():
-	for user in db.session.query(db.User):
-		try:
-			key_info = check_api_key(user.apikey_id, user.apikey_vcode)
-		except InvalidAPI as e:
-			user.character.parent_id = None
-			print('%s: %s' % (user.username, e.message))
-			continue
-		for char in key_info['characters']:
-			if char['character_id'] == user.character_id:
-				update_for_char(char)
-				break
-		else:
-			# couldn't find the character
-			user.character.parent_id = None
-			print(user.username + ": Key didn't have the character we were looking for.")
-		time.sleep(1)
+	users = db.session.query(db.User).all()
+	batch = EntityBatch()
+	detached = []
+	# the API calls fan out over the pool (ccp_pls.query enforces the global rate limit);
+	# all database work stays on this thread as results come back
+	with concurrent.futures.ThreadPoolExecutor(config.api_concurrency) as executor:
+		futures = {executor.submit(fetch_key_info, user): user for user in users}
+		for future in concurrent.futures.as_completed(futures):
+			user = futures[future]
+			try:
+				key_info = future.result()
+			except (requests.RequestException, ElementTree.ParseError) as e:
+				# transient API trouble (or an HTML error page); leave the user as they were until the next run
+				print('%s: %s' % (user.username, e))
+				continue
+			if isinstance(key_info, InvalidAPI):
+				detached.append(user.character_id)
+				print('%s: %s' % (user.username, key_info.message))
+				continue
+			for char in key_info['characters']:
+				if char['character_id'] == user.character_id:
+					batch.add_char(char)
+					break
+			else:
+				# couldn't find the character
+				detached.append(user.character_id)
+				print(user.username + ": Key didn't have the character we were looking for.")
+
+	# everything lands in one transaction
+	batch.flush()
+	if detached:
+		db.session.query(db.Entity).filter(db.Entity.id.in_(detached)) \
+				.update({'parent_id': None}, synchronize_session=False)
+	db.refresh_effective_groups()
+	db.session.commit()
+	db.user_cache.invalidate()
 
 if __name__ == '__main__':
 	main()